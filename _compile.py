@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# Build netsonus_kernels, an ahead-of-time compiled extension with the
+# kernels from netsonus_jit, so streaming starts without JIT warm-up.
+# Run once after installing: python _compile.py
+import os
+from numba.pycc import CC
+import netsonus_jit
+
+cc = CC('netsonus_kernels')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+
+cc.export('process_block', 'UniTuple(i8, 2)(i2[:], i2[:], f8, b1)')(netsonus_jit.process_block.py_func)
+cc.export('peak_abs', 'i8(i2[:])')(netsonus_jit.peak_abs.py_func)
+cc.export('mulaw_encode', 'void(i2[:], u1[:])')(netsonus_jit.mulaw_encode.py_func)
+cc.export('mulaw_decode', 'void(u1[:], i2[:])')(netsonus_jit.mulaw_decode.py_func)
+
+if __name__ == '__main__':
+    cc.compile()
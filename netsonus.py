@@ -16,8 +16,8 @@ import struct
 # Platform-specific imports
 if sys.platform == 'darwin':  # macOS
     import pyaudio
-    import netifaces
 elif sys.platform == 'win32':  # Windows
+    import ctypes
     import sounddevice as sd
 else:
     print("Unsupported platform")
@@ -33,16 +33,46 @@ logging.basicConfig(
     ]
 )
 
+# Number of slots in the capture ring buffer (must be a power of two)
+RING_SLOTS = 8
+
+# Win32 THREAD_PRIORITY_TIME_CRITICAL
+THREAD_PRIORITY_TIME_CRITICAL = 15
+
+# Packets start with a little-endian uint32 sequence number
+SEQ_HEADER = struct.Struct('<I')
+HEADER_SIZE = SEQ_HEADER.size
+
+# Receiver reorder window in blocks; packets further behind than this mean
+# the sender restarted
+JITTER_SLOTS = 3
+
+# Prefer the ahead-of-time compiled kernels built by _compile.py
+try:
+    from netsonus_kernels import process_block, peak_abs, mulaw_encode, mulaw_decode
+except ImportError:
+    from netsonus_jit import process_block, peak_abs, mulaw_encode, mulaw_decode
+
 class AudioStreamer:
+    __slots__ = (
+        'config', 'running', 'sock', 'recording', 'volume', 'peak_level', 'dropped_packets',
+        'rate', 'blocksize', 'channels', 'timeout', 'noise_threshold', 'auto_gain',
+        'record_path', 'codec', 'socket_buffer', 'stream', 'p', 'recording_file',
+        '_in_buf', '_out_buf', '_in_view', '_out_view',
+        '_mulaw', '_packet_size', '_gate_sum',
+        '_ring', '_ring_payload', '_ring_i16', '_ring_views', '_states', '_head', '_seq', '_ring_ready',
+        '_rx_buf', '_rx_view', '_rx_payload', '_rx_samples', '_jb', '_jb_views', '_jb_seq',
+        '_dest', '_wav', '_record_queue', '_record_thread',
+    )
+
     def __init__(self, config):
         self.config = config
         self.running = False
-        self.audio_queue = queue.Queue()
         self.sock = None
         self.recording = False
         self.volume = 1.0
         self.peak_level = 0
-        self.recording_buffer = []
+        self.dropped_packets = 0
         
         # Initialize audio parameters
         self.rate = config.get('rate', 44100)
@@ -52,38 +82,130 @@ class AudioStreamer:
         self.noise_threshold = config.get('noise_threshold', 500)
         self.auto_gain = config.get('auto_gain', False)
         self.record_path = config.get('record_path', 'recordings')
+        self.codec = config.get('codec', 'pcm')
+        self.socket_buffer = config.get('socket_buffer', 256 * 1024)
 
     def setup_audio(self):
         try:
+            # Preallocate block buffers and compile the kernel before streaming
+            self._in_buf = np.zeros(self.blocksize * self.channels, dtype=np.int16)
+            self._out_buf = np.empty(self.blocksize * self.channels, dtype=np.int16)
+            self._in_view = memoryview(self._in_buf).cast('B')
+            self._out_view = memoryview(self._out_buf).cast('B')
+
+            # Single-producer/single-consumer ring between capture callback and sender
+            self._mulaw = self.codec == 'mulaw'
+            sample_width = 1 if self._mulaw else 2
+            packet_size = HEADER_SIZE + self._in_buf.size * sample_width
+            self._packet_size = packet_size
+            self._gate_sum = self.noise_threshold * self._in_buf.size
+            self._ring = np.empty((RING_SLOTS, packet_size), dtype=np.uint8)
+            self._ring_payload = self._ring[:, HEADER_SIZE:]
+            self._ring_i16 = None if self._mulaw else self._ring_payload.view(np.int16)
+            self._ring_views = [memoryview(slot) for slot in self._ring]
+            self._states = np.zeros(RING_SLOTS, dtype=np.uint8)
+            self._head = 0
+            self._seq = 0
+            self._ring_ready = threading.Event()
+
+            # Receive buffer and jitter buffer slots keyed by seq % JITTER_SLOTS
+            # One spare byte so oversized packets show up as a size mismatch
+            self._rx_buf = np.empty(packet_size + 1, dtype=np.uint8)
+            self._rx_view = memoryview(self._rx_buf)
+            self._rx_payload = self._rx_buf[HEADER_SIZE:packet_size]
+            self._rx_samples = None if self._mulaw else self._rx_payload.view(np.int16)
+            # The extra last row stays zero and is played in place of lost blocks
+            self._jb = np.zeros((JITTER_SLOTS + 1, self._in_buf.size), dtype=np.int16)
+            self._jb_views = [memoryview(row).cast('B') for row in self._jb]
+            self._jb_seq = [None] * JITTER_SLOTS
+            process_block(self._in_buf, self._out_buf, self.volume, self.auto_gain)
+            peak_abs(self._in_buf)
+            if self._mulaw:
+                mulaw_encode(self._in_buf, self._rx_payload)
+                mulaw_decode(self._rx_payload, self._out_buf)
+
+            capture = self.config['mode'] == 'send'
             if sys.platform == 'darwin':
                 self.p = pyaudio.PyAudio()
                 self.stream = self.p.open(
                     format=pyaudio.get_format_from_width(2),
                     channels=self.channels,
                     rate=self.rate,
-                    input=True,
-                    output=True,
-                    frames_per_buffer=self.blocksize
+                    input=capture,
+                    output=not capture,
+                    frames_per_buffer=self.blocksize,
+                    stream_callback=self._pa_capture if capture else None
                 )
             elif sys.platform == 'win32':
-                self.stream = sd.Stream(
+                stream_type = sd.RawInputStream if capture else sd.RawOutputStream
+                self.stream = stream_type(
                     samplerate=self.rate,
                     channels=self.channels,
                     blocksize=self.blocksize,
-                    dtype=np.int16
+                    dtype='int16',
+                    callback=self._sd_capture if capture else None
                 )
+                self.stream.start()
             logging.info("Audio setup completed successfully")
         except Exception as e:
             logging.error(f"Failed to setup audio: {e}")
             raise
 
+    def _on_capture(self, in_data):
+        """Process a captured block into the next free ring slot"""
+        self._in_view[:] = in_data
+        
+        # Record if enabled
+        if self.recording:
+            self._record_queue.put(self._in_buf.copy())
+        
+        # Drop the block if the sender has not freed this slot yet
+        head = self._head
+        states = self._states
+        if states[head]:
+            return
+        
+        # Apply auto-gain and volume, update peak level
+        mulaw = self._mulaw
+        out_i16 = self._out_buf if mulaw else self._ring_i16[head]
+        self.peak_level, abs_sum = process_block(
+            self._in_buf, out_i16, self.volume, self.auto_gain
+        )
+        
+        # Publish if mean level is above noise threshold
+        if abs_sum > self._gate_sum:
+            if mulaw:
+                mulaw_encode(out_i16, self._ring_payload[head])
+            seq = self._seq
+            SEQ_HEADER.pack_into(self._ring_views[head], 0, seq)
+            self._seq = (seq + 1) & 0xFFFFFFFF
+            states[head] = 1
+            head = (head + 1) & (RING_SLOTS - 1)
+            self._head = head
+            if not self._ring_ready.is_set():
+                self._ring_ready.set()
+
+    def _pa_capture(self, in_data, frame_count, time_info, status):
+        """PyAudio input callback"""
+        self._on_capture(in_data)
+        return (None, pyaudio.paContinue)
+
+    def _sd_capture(self, indata, frames, time_info, status):
+        """sounddevice input callback"""
+        self._on_capture(indata)
+
     def setup_network(self):
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.socket_buffer)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.socket_buffer)
             if self.config['mode'] == 'receive':
                 self.sock.bind(('0.0.0.0', self.config['port']))
+                # Flush the jitter buffer when nothing arrives for a full window
+                self.sock.settimeout(JITTER_SLOTS * self.blocksize / self.rate)
             else:
                 self.sock.settimeout(self.timeout)
+                self._dest = (self.config['ip'], self.config['port'])
             logging.info(f"Network setup completed for {self.config['mode']} mode")
         except Exception as e:
             logging.error(f"Failed to setup network: {e}")
@@ -109,40 +231,39 @@ class AudioStreamer:
         self.volume = max(0.0, min(1.0, volume))
         logging.info(f"Volume set to {self.volume}")
 
-    def get_peak_level(self, audio_data):
-        """Calculate peak audio level"""
-        return np.abs(audio_data).max()
-
-    def apply_auto_gain(self, audio_data):
-        """Apply automatic gain control"""
-        if not self.auto_gain:
-            return audio_data
-        
-        peak = self.get_peak_level(audio_data)
-        if peak > 0:
-            gain = min(1.0, 32767 / peak)
-            return (audio_data * gain).astype(np.int16)
-        return audio_data
-
     def start_recording(self):
         """Start recording audio to WAV file"""
         if not self.recording:
-            self.recording = True
-            self.recording_buffer = []
             os.makedirs(self.record_path, exist_ok=True)
             timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
             self.recording_file = os.path.join(self.record_path, f"recording_{timestamp}.wav")
+            
+            # Blocks are streamed to disk by a writer thread as they arrive
+            self._wav = wave.open(self.recording_file, 'wb')
+            self._wav.setnchannels(self.channels)
+            self._wav.setsampwidth(2)  # 16-bit audio
+            self._wav.setframerate(self.rate)
+            self._record_queue = queue.SimpleQueue()
+            self._record_thread = threading.Thread(target=self._record_writer, daemon=True)
+            self._record_thread.start()
+            self.recording = True
             logging.info(f"Started recording to {self.recording_file}")
 
+    def _record_writer(self):
+        """Write queued blocks to the WAV file until stop_recording queues None"""
+        while True:
+            block = self._record_queue.get()
+            if block is None:
+                break
+            self._wav.writeframesraw(block)
+
     def stop_recording(self):
-        """Stop recording and save WAV file"""
+        """Stop recording and finalize WAV file"""
         if self.recording:
             self.recording = False
-            with wave.open(self.recording_file, 'wb') as wf:
-                wf.setnchannels(self.channels)
-                wf.setsampwidth(2)  # 16-bit audio
-                wf.setframerate(self.rate)
-                wf.writeframes(b''.join(self.recording_buffer))
+            self._record_queue.put(None)
+            self._record_thread.join()
+            self._wav.close()  # Patches the RIFF header with the final length
             logging.info(f"Recording saved to {self.recording_file}")
 
     def discover_devices(self):
@@ -151,22 +272,12 @@ class AudioStreamer:
         discovery_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         discovery_sock.settimeout(1)
         
-        # Get local network interfaces
-        interfaces = []
-        if sys.platform == 'darwin':
-            for interface in netifaces.interfaces():
-                addrs = netifaces.ifaddresses(interface)
-                if netifaces.AF_INET in addrs:
-                    for addr in addrs[netifaces.AF_INET]:
-                        if 'addr' in addr and not addr['addr'].startswith('127.'):
-                            interfaces.append(addr['addr'])
-        
         # Broadcast discovery message
-        for interface in interfaces:
-            try:
-                discovery_sock.sendto(b'NETSONUS_DISCOVER', (interface, discovery_port))
-            except Exception as e:
-                logging.error(f"Discovery error on {interface}: {e}")
+        discovery_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        try:
+            discovery_sock.sendto(b'NETSONUS_DISCOVER', ('255.255.255.255', discovery_port))
+        except Exception as e:
+            logging.error(f"Discovery broadcast error: {e}")
         
         # Listen for responses
         devices = []
@@ -181,64 +292,133 @@ class AudioStreamer:
         discovery_sock.close()
         return devices
 
+    def raise_thread_priority(self):
+        """Raise the calling thread's scheduling priority for streaming"""
+        if sys.platform == 'win32':
+            kernel32 = ctypes.windll.kernel32
+            if not kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_PRIORITY_TIME_CRITICAL):
+                logging.warning("Failed to raise thread priority")
+
     def sender_loop(self):
         print(f"Starting sender to {self.config['ip']}:{self.config['port']}")
+        self.raise_thread_priority()
+        dest = self._dest
+        send = self.sock.sendto
+        views = self._ring_views
+        states = self._states
+        tail = 0
         while self.running:
             try:
-                if sys.platform == 'darwin':
-                    data = self.stream.read(self.blocksize)
-                else:
-                    data, _ = self.stream.read(self.blocksize)
-                    data = data.tobytes()
-                
-                # Process audio data
-                audio_data = np.frombuffer(data, dtype=np.int16)
+                if not states[tail]:
+                    # Ring is empty, sleep until the capture callback publishes a slot
+                    self._ring_ready.clear()
+                    if not states[tail]:
+                        self._ring_ready.wait(self.timeout)
+                    continue
                 
-                # Apply volume and auto-gain
-                audio_data = self.apply_auto_gain(audio_data)
-                audio_data = (audio_data * self.volume).astype(np.int16)
-                
-                # Update peak level
-                self.peak_level = self.get_peak_level(audio_data)
-                
-                # Record if enabled
-                if self.recording:
-                    self.recording_buffer.append(data)
-                
-                # Send if above noise threshold
-                if np.abs(audio_data).mean() > self.noise_threshold:
-                    self.sock.sendto(audio_data.tobytes(), (self.config['ip'], self.config['port']))
+                # Send every ready slot before sleeping again
+                while states[tail]:
+                    send(views[tail], dest)
+                    states[tail] = 0
+                    tail = (tail + 1) & (RING_SLOTS - 1)
             except Exception as e:
                 logging.error(f"Sender error: {e}")
                 time.sleep(0.1)
 
     def receiver_loop(self):
         print(f"Starting receiver on port {self.config['port']}")
+        self.raise_thread_priority()
+        recv_into = self.sock.recv_into
+        unpack_seq = SEQ_HEADER.unpack_from
+        rx_view = self._rx_view
+        packet_size = self._packet_size
+        jb = self._jb
+        jb_seq = self._jb_seq
+        expected = None
+        bad_size = None
         while self.running:
             try:
-                data, addr = self.sock.recvfrom(self.blocksize * self.channels * 2)
-                audio_data = np.frombuffer(data, dtype=np.int16)
+                nbytes = recv_into(rx_view)
+                if nbytes != packet_size:
+                    if nbytes != bad_size:
+                        bad_size = nbytes
+                        self._warn_packet_size(nbytes)
+                    continue
                 
-                # Apply volume
-                audio_data = (audio_data * self.volume).astype(np.int16)
+                seq = unpack_seq(rx_view)[0]
+                if expected is None or not expected - JITTER_SLOTS <= seq < expected + 2 * JITTER_SLOTS:
+                    # First packet, sender restart or long outage: resynchronize
+                    if expected is not None and seq > expected:
+                        self.dropped_packets += seq - expected
+                    jb_seq[:] = [None] * JITTER_SLOTS
+                    expected = seq
+                elif seq < expected:
+                    # Arrived after its block was already played or concealed
+                    continue
                 
-                # Update peak level
-                self.peak_level = self.get_peak_level(audio_data)
+                # Conceal blocks pushed out of the reorder window by this packet
+                while seq - expected >= JITTER_SLOTS:
+                    expected = self._play_next(expected)
                 
-                # Record if enabled
-                if self.recording:
-                    self.recording_buffer.append(data)
-                
-                if sys.platform == 'darwin':
-                    self.stream.write(audio_data.tobytes())
+                slot = seq % JITTER_SLOTS
+                if self._mulaw:
+                    mulaw_decode(self._rx_payload, jb[slot])
                 else:
-                    self.stream.write(audio_data)
+                    jb[slot] = self._rx_samples
+                jb_seq[slot] = seq
+                
+                # Play every block that is now in order
+                while jb_seq[expected % JITTER_SLOTS] == expected:
+                    expected = self._play_next(expected)
             except socket.timeout:
+                # Sender went quiet: conceal the gap and play out held blocks
+                while any(held is not None for held in jb_seq):
+                    expected = self._play_next(expected)
                 continue
             except Exception as e:
                 logging.error(f"Receiver error: {e}")
                 time.sleep(0.1)
 
+    def _warn_packet_size(self, nbytes):
+        """Log why packets of an unexpected size are being dropped"""
+        other_codec = 'pcm' if self._mulaw else 'mulaw'
+        other_width = 2 if self._mulaw else 1
+        if nbytes == HEADER_SIZE + self._in_buf.size * other_width:
+            hint = f"sender appears to use --codec {other_codec}, receiver uses --codec {self.codec}"
+        else:
+            hint = "check that --codec, --blocksize and --channels match the sender"
+        logging.warning(f"Dropping {nbytes}-byte packets, expected {self._packet_size}: {hint}")
+
+    def _play_next(self, expected):
+        """Play block `expected` from the jitter buffer, or silence if it was lost"""
+        slot = expected % JITTER_SLOTS
+        if self._jb_seq[slot] == expected:
+            self._jb_seq[slot] = None
+        else:
+            slot = JITTER_SLOTS
+            self.dropped_packets += 1
+        samples = self._jb[slot]
+        
+        if self.volume == 1.0:
+            # Unity volume: play the block in place and only measure its peak
+            self.peak_level = peak_abs(samples)
+            out_view = self._jb_views[slot]
+        else:
+            # Apply volume and update peak level
+            self.peak_level, _ = process_block(samples, self._out_buf, self.volume, False)
+            out_view = self._out_view
+        
+        # Record if enabled
+        if self.recording:
+            self._record_queue.put(samples.copy())
+        
+        if sys.platform == 'darwin':
+            # PyAudio only accepts bytes for blocking writes
+            self.stream.write(out_view.tobytes())
+        else:
+            self.stream.write(out_view)
+        return expected + 1
+
     def start(self):
         self.running = True
         self.setup_audio()
@@ -254,7 +434,10 @@ class AudioStreamer:
         if self.recording:
             self.stop_recording()
         if hasattr(self, 'stream'):
-            self.stream.stop_stream()
+            if sys.platform == 'darwin':
+                self.stream.stop_stream()
+            else:
+                self.stream.stop()
             self.stream.close()
         if hasattr(self, 'p'):
             self.p.terminate()
@@ -285,6 +468,8 @@ def main():
     parser.add_argument('--timeout', type=int, default=2, help='Network timeout in seconds (default: 2)')
     parser.add_argument('--volume', type=float, default=1.0, help='Output volume (0.0 to 1.0)')
     parser.add_argument('--auto-gain', action='store_true', help='Enable automatic gain control')
+    parser.add_argument('--codec', choices=['pcm', 'mulaw'], default='pcm',
+                      help='Payload encoding: 16-bit PCM or 8-bit mu-law (default: pcm)')
     parser.add_argument('--record', action='store_true', help='Enable audio recording')
     parser.add_argument('--discover', action='store_true', help='Discover NetSonus devices on network')
     parser.add_argument('--list-devices', action='store_true', help='List available audio devices')
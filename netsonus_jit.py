@@ -0,0 +1,73 @@
+# Numba kernels for the audio hot path. _compile.py builds these ahead of
+# time into netsonus_kernels; this module is the JIT fallback.
+import numpy as np
+from numba import njit
+
+@njit(cache=True, fastmath=True)
+def process_block(in_i16, out_i16, volume, auto_gain):
+    """Apply auto-gain and volume into out_i16, returning (peak, sum of |samples|)"""
+    n = in_i16.size
+    gain = volume
+    if auto_gain:
+        in_peak = 0
+        for i in range(n):
+            x = abs(np.int32(in_i16[i]))
+            if x > in_peak:
+                in_peak = x
+        if in_peak > 0:
+            gain = min(1.0, 32767.0 / in_peak) * volume
+
+    peak = 0
+    total = 0
+    for i in range(n):
+        y = np.int16(in_i16[i] * gain)
+        out_i16[i] = y
+        a = abs(np.int32(y))
+        total += a
+        if a > peak:
+            peak = a
+    return peak, total
+
+@njit(cache=True)
+def peak_abs(in_i16):
+    """Return max(|x|) over int16 samples in a single read-only pass"""
+    peak = 0
+    for i in range(in_i16.size):
+        a = abs(np.int32(in_i16[i]))
+        if a > peak:
+            peak = a
+    return peak
+
+# G.711 mu-law: exponent lookup for encoding and full decode table
+MULAW_BIAS = 0x84
+MULAW_CLIP = 32635
+MULAW_EXP = np.array([max(i.bit_length() - 1, 0) for i in range(256)], dtype=np.uint8)
+
+def _mulaw_expand(code):
+    code = ~code & 0xFF
+    sample = ((((code & 0x0F) << 3) + MULAW_BIAS) << ((code >> 4) & 0x07)) - MULAW_BIAS
+    return -sample if code & 0x80 else sample
+
+MULAW_DECODE = np.array([_mulaw_expand(code) for code in range(256)], dtype=np.int16)
+
+@njit(cache=True)
+def mulaw_encode(in_i16, out_u8):
+    """Compress int16 samples to 8-bit G.711 mu-law codes"""
+    for i in range(in_i16.size):
+        x = np.int32(in_i16[i])
+        sign = 0
+        if x < 0:
+            sign = 0x80
+            x = -x
+        if x > MULAW_CLIP:
+            x = MULAW_CLIP
+        x += MULAW_BIAS
+        exponent = MULAW_EXP[(x >> 7) & 0xFF]
+        mantissa = (x >> (exponent + 3)) & 0x0F
+        out_u8[i] = ~(sign | (exponent << 4) | mantissa) & 0xFF
+
+@njit(cache=True)
+def mulaw_decode(in_u8, out_i16):
+    """Expand 8-bit G.711 mu-law codes to int16 samples"""
+    for i in range(in_u8.size):
+        out_i16[i] = MULAW_DECODE[in_u8[i]]